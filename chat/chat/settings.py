@@ -75,9 +75,38 @@ TEMPLATES = [
 WSGI_APPLICATION = 'chat.wsgi.application'
 ASGI_APPLICATION = 'chat.asgi.application'  # замените на ваше имя проекта
 
+# Redis хранит общее состояние чата и служит слоем каналов для всех воркеров
+REDIS_URL = 'redis://127.0.0.1:6379/0'
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': [REDIS_URL],
+            # Ограничиваем очередь канала: медленный клиент не должен раздувать память Redis.
+            # Это единственная защита от медленных клиентов - send() в Daphne не ждет сам сокет
+            'capacity': 50,
+        },
+    },
+}
+
+# Logging
+# https://docs.djangoproject.com/en/5.2/topics/logging/
+
+# Отладочные сообщения чата пишем только при DEBUG, в продакшене они отбрасываются без форматирования
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'room': {
+            'handlers': ['console'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+        },
     },
 }
 
@@ -88,9 +117,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Держим соединения открытыми между запросами consumer'ов вместо подключения на каждый вызов
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Размер пула потоков, в котором consumer'ы чата выполняют запросы к БД
+DB_THREAD_POOL_SIZE = 32
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
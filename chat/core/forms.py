@@ -1,5 +1,7 @@
+from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import UserCreationForm
-from django.contrib.auth.forms import User
+
+User = get_user_model()
 
 class SingUpForm(UserCreationForm):
     class Meta:
@@ -4,9 +4,22 @@ import os
 import sys
 
 
+def install_uvloop():
+    """Use uvloop for the event loop Daphne creates, if it is installed."""
+    # Daphne creates its loop when daphne.server is imported, so the policy
+    # has to be set before any management command runs.
+    try:
+        import asyncio
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 def main():
     """Run administrative tasks."""
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat.settings')
+    install_uvloop()
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
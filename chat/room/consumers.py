@@ -1,36 +1,377 @@
-import json
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timezone as dt_tz
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import msgspec
+import orjson
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
 from .models import Message, Room, PrivateMessage
-from django.contrib.auth.models import User
-from asgiref.sync import sync_to_async
-from django.utils import timezone
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.db.models import Max, Q
+from .events import IncomingMessage, NewMessageFrame, UserActivityFrame, BufferedMessage
+from .redis_client import get_redis, get_script, presence_key, connections_key, buffer_key
+
+logger = logging.getLogger(__name__)
+
+# Модель пользователя получаем один раз при импорте, а не при каждом запросе
+User = get_user_model()
+
+# Отдельный пул потоков для запросов к БД: запросы разных соединений идут параллельно,
+# а не по очереди через единственный поток sync_to_async(thread_sensitive=True)
+db_executor = ThreadPoolExecutor(
+    max_workers=settings.DB_THREAD_POOL_SIZE,
+    thread_name_prefix='chat-db'
+)
+
+
+def db_sync_to_async(func):
+    """Выполняет функцию в пуле db_executor.
+
+    database_sync_to_async вызывает close_old_connections до и после запроса,
+    поэтому соединения потоков пула живут CONN_MAX_AGE и проверяются перед использованием.
+    """
+    return database_sync_to_async(func, thread_sensitive=False, executor=db_executor)
+
+
+# Сколько последних сообщений комнаты храним в буфере Redis
+MESSAGE_BUFFER_SIZE = 50
+
+# Кадры ошибок не меняются - сериализуем их один раз при импорте
+ERROR_USER_NOT_FOUND = orjson.dumps({
+    'type': 'error',
+    'message': 'Пользователь не найден'
+})
+ERROR_PRIVATE_MESSAGE_FAILED = orjson.dumps({
+    'type': 'error',
+    'message': 'Не удалось отправить личное сообщение'
+})
+
+# Запись в списке онлайн живет PRESENCE_TTL секунд и продлевается каждые PRESENCE_HEARTBEAT секунд,
+# поэтому пользователи упавшего воркера не попадают в список, который получают новые участники.
+# Уже подключенным клиентам событие выхода для таких записей не рассылается
+PRESENCE_TTL = 60
+PRESENCE_HEARTBEAT = 30
+
+# Присутствие хранится по соединениям: KEYS[1] - пользователи комнаты, KEYS[2] - соединения пользователя.
+# Отмечает соединение живым и возвращает, сколько других живых соединений было у пользователя
+TOUCH_PRESENCE_SCRIPT = """
+local cutoff = tonumber(ARGV[3]) - tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', cutoff)
+local others = redis.call('ZCARD', KEYS[2])
+if redis.call('ZSCORE', KEYS[2], ARGV[2]) then
+    others = others - 1
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', cutoff)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return others
+"""
+
+# Убирает соединение; пользователя из комнаты - только если живых соединений у него не осталось.
+# Возвращает 1, если пользователь покинул комнату
+LEAVE_PRESENCE_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[4]))
+if redis.call('ZCARD', KEYS[2]) > 0 then
+    return 0
+end
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+# Сколько секунд доверяем кэшу проверок существования комнат и пользователей
+EXISTS_CACHE_TTL = 60
+
+# Подтвержденные записи: slug -> (monotonic, id комнаты), username -> (monotonic, id пользователя).
+# Кэшируем только положительные ответы, чтобы новые комнаты и пользователи были видны сразу
+_room_cache = {}
+_user_cache = {}
+
+
+def get_cached(cache, key):
+    """Возвращает значение из кэша, если оно подтверждено не раньше EXISTS_CACHE_TTL секунд назад"""
+    entry = cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < EXISTS_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+# Текст уведомлений о входе и выходе пользователя
+ACTIVITY_MESSAGES = {
+    'joined': 'присоединился к чату',
+    'left': 'покинул чат',
+}
+
+# Накопленные события присутствия по комнатам: пока ключ есть, рассылка уже запланирована
+_presence_queues = {}
+
+# Закрытое соединение еще PRESENCE_LEAVE_GRACE секунд считается живым: если пользователь за это время
+# переподключится (обрыв сети на телефоне, перезагрузка страницы) к любому воркеру, ни вход,
+# ни выход не рассылаются - состав комнаты не меняется
+PRESENCE_LEAVE_GRACE = 2.0
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+# Счетчик id сообщений в Redis: id выдается до записи в БД, чтобы разослать сообщение сразу.
+# Сообщения создаются только этим consumer'ом, поэтому последовательность БД не используется
+MESSAGE_ID_KEY = 'message:last_id'
+
+# Следующий id, если счетчик существует; 0 - счетчика нет (первый запуск или Redis потерял данные)
+NEXT_MESSAGE_ID_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('INCR', KEYS[1])
+"""
+
+# Поднимает счетчик не ниже ARGV[1] и выдает следующий id. Счетчик только растет,
+# поэтому одновременный запуск из нескольких процессов безопасен
+SEED_MESSAGE_ID_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('INCR', KEYS[1])
+"""
+
+# Наибольший id, выданный этим процессом: такие сообщения могут быть еще не записаны в БД
+_last_message_id = 0
+
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей и удерживает ссылку на нее до завершения"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+@db_sync_to_async
+def get_last_message_id():
+    """Возвращает наибольший id сообщения в БД"""
+    return Message.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+async def seed_message_id():
+    """Поднимает счетчик не ниже последнего id в БД и выданных процессом и выдает следующий id"""
+    global _last_message_id
+    last_id = max(await get_last_message_id(), _last_message_id)
+    message_id = await get_script(SEED_MESSAGE_ID_SCRIPT)(keys=[MESSAGE_ID_KEY], args=[last_id])
+    logger.info("🔢 Счетчик id сообщений поднят до %s", last_id)
+    _last_message_id = max(_last_message_id, message_id)
+    return message_id
+
+
+async def next_message_id():
+    """Выдает следующий id сообщения из общего счетчика Redis"""
+    global _last_message_id
+    message_id = await get_script(NEXT_MESSAGE_ID_SCRIPT)(keys=[MESSAGE_ID_KEY])
+    if not message_id:
+        # Счетчика нет - заводим его заново от последнего id в БД, иначе новые id совпадут со старыми
+        return await seed_message_id()
+    _last_message_id = max(_last_message_id, message_id)
+    return message_id
+
+
+# Сообщения, ожидающие записи в БД: пишем их пачками одной фоновой задачей на процесс
+# Пачка уходит в БД, как только набралось WRITE_BATCH_SIZE сообщений или прошло WRITE_BATCH_WAIT секунд
+WRITE_BATCH_SIZE = 50
+WRITE_BATCH_WAIT = 0.02
+_write_queue = None
+_write_batch_full = None
+_writer_task = None
+
+
+def enqueue_message_write(message_obj, room_slug, buffered):
+    """Ставит уже разосланное сообщение в очередь на запись и при необходимости запускает писателя"""
+    global _write_queue, _write_batch_full, _writer_task
+    if _write_queue is None:
+        _write_queue = asyncio.Queue()
+        _write_batch_full = asyncio.Event()
+    if _writer_task is None or _writer_task.done():
+        _writer_task = run_in_background(write_messages(_write_queue, _write_batch_full))
+    _write_queue.put_nowait((message_obj, room_slug, buffered))
+    if _write_queue.qsize() >= WRITE_BATCH_SIZE:
+        _write_batch_full.set()
+
+
+async def drain(queue, max_items, max_wait, full):
+    """Дожидается первого элемента, затем копит остальные, пока их не станет max_items
+    (об этом сообщает событие full) или не пройдет max_wait секунд"""
+    items = [await queue.get()]
+    if queue.qsize() < max_items - 1:
+        try:
+            # Ждем только событие, а не сам get - отмена по таймауту не теряет элементов
+            await asyncio.wait_for(full.wait(), timeout=max_wait)
+        except asyncio.TimeoutError:
+            pass
+    full.clear()
+    while len(items) < max_items and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+@db_sync_to_async
+def save_messages(messages):
+    """Сохраняет пачку сообщений одним INSERT.
+
+    Возвращает сообщения, которые сохранить не удалось, и признак того, что их id уже заняты в БД.
+    """
+    try:
+        Message.objects.bulk_create(messages)
+        logger.debug("💾 Сохранено сообщений одной пачкой: %s", len(messages))
+        return [], False
+    except Exception as e:
+        logger.exception("❌ Ошибка пакетного сохранения сообщений: %s", e)
+
+    # Одна плохая запись не должна терять всю пачку - сохраняем по одному
+    failed = []
+    id_conflict = False
+    for message_obj in messages:
+        try:
+            message_obj.save(force_insert=True)
+        except Exception as e:
+            logger.exception("❌ Ошибка сохранения сообщения %s: %s", message_obj.id, e)
+            failed.append(message_obj)
+            if isinstance(e, IntegrityError) and Message.objects.filter(id=message_obj.id).exists():
+                id_conflict = True
+    return failed, id_conflict
+
+
+async def write_messages(queue, full):
+    """Фоновый писатель: сохраняет сообщения из очереди пачками через bulk_create"""
+    while True:
+        batch = await drain(queue, WRITE_BATCH_SIZE, WRITE_BATCH_WAIT, full)
+        try:
+            failed, id_conflict = await save_messages([message_obj for message_obj, _, _ in batch])
+            if id_conflict:
+                # Счетчик отстал от БД (failover, восстановление из старого снимка) - поднимаем его,
+                # чтобы терялась только эта пачка, а не каждое сообщение до тех пор, пока INCR не догонит БД
+                await seed_message_id()
+            if failed:
+                failed_ids = {message_obj.id for message_obj in failed}
+                for message_obj, room_slug, buffered in batch:
+                    if message_obj.id in failed_ids:
+                        await retract_message(message_obj.id, room_slug, buffered)
+        except Exception as e:
+            logger.exception("❌ Ошибка фоновой записи сообщений: %s", e)
+
+
+async def retract_message(message_id, room_slug, buffered):
+    """Убирает несохраненное сообщение из буфера и отзывает его у участников комнаты"""
+    logger.error("❌ Не удалось сохранить сообщение %s, отзываем его", message_id)
+    await get_redis().lrem(buffer_key(room_slug), 1, buffered)
+    await get_channel_layer().group_send(
+        f'chat_{room_slug}',
+        {
+            'type': 'message_retract',
+            'frame': orjson.dumps({
+                'type': 'message_retract',
+                'message_id': message_id,
+            }),
+        }
+    )
+
+
+async def flush_presence(channel_layer, room_slug, room_group_name):
+    """Собирает все события присутствия комнаты за один оборот цикла и рассылает их одним group_send.
+
+    Рассылаются только изменения (кто вошел, кто вышел) - полный список получает лишь новый участник.
+    """
+    # Даем другим подключениям/отключениям этого оборота попасть в ту же пачку
+    await asyncio.sleep(0)
+
+    queue = _presence_queues.pop(room_slug)
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+
+    try:
+        # Кадры сериализуем один раз здесь, а не в каждом получателе
+        frames = [orjson.dumps(activity) for activity in events]
+
+        await channel_layer.group_send(
+            room_group_name,
+            {
+                'type': 'presence_batch',
+                'frames': frames
+            }
+        )
+        logger.debug("👥 Отправлено %s событий присутствия в комнату %s", len(events), room_slug)
+    except Exception as e:
+        logger.exception("❌ Ошибка рассылки событий присутствия: %s", e)
+
+
+# Кадры со списком онлайн пользователей, собираемые в текущем обороте цикла: slug -> Future
+_presence_snapshots = {}
+
+
+async def build_presence_snapshot(room_slug, future):
+    """Читает список онлайн пользователей комнаты один раз на всех, кто запросил его за этот оборот"""
+    # Чтение начинается после того, как все подключения этого оборота добавили себя в список
+    await asyncio.sleep(0)
+    _presence_snapshots.pop(room_slug, None)
+
+    try:
+        # Записи без продления за PRESENCE_TTL считаем зависшими и не показываем
+        users = await get_redis().zrangebyscore(presence_key(room_slug), time.time() - PRESENCE_TTL, '+inf')
+        future.set_result(orjson.dumps({
+            'type': 'online_users',
+            'users': users,
+            'count': len(users)
+        }))
+    except Exception as e:
+        future.set_exception(e)
+
+
+async def get_presence_snapshot(room_slug):
+    """Возвращает готовый кадр со списком онлайн пользователей комнаты"""
+    future = _presence_snapshots.get(room_slug)
+    if future is None:
+        future = _presence_snapshots[room_slug] = asyncio.get_running_loop().create_future()
+        run_in_background(build_presence_snapshot(room_slug, future))
+    return await asyncio.shield(future)
+
+
+def user_group_name(user_id):
+    """Группа всех соединений пользователя - через нее доставляются личные сообщения"""
+    return f'user_{user_id}'
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    # Храним подключенных пользователей по комнатам
-    connected_users = {}
-    
-    # Храним channel_name для каждого пользователя для личных сообщений
-    user_channels = {}
-    
-    # Буфер для временного хранения сообщений во время переподключения
-    message_buffer = {}
-    
     async def connect(self):
         self.room_slug = self.scope['url_route']['kwargs']['room_slug']
         self.room_group_name = f'chat_{self.room_slug}'
         self.user = self.scope["user"]
 
+        # Переподключившийся клиент передает id последнего полученного сообщения
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            self.last_seen_id = int(query.get('last_seen_id', ['0'])[0])
+        except ValueError:
+            self.last_seen_id = 0
+
         # Проверяем аутентификацию пользователя
         if self.user.is_anonymous:
-            print("❌ Анонимный пользователь пытается подключиться")
+            logger.warning("❌ Анонимный пользователь пытается подключиться")
             await self.close()
             return
 
         # Проверяем существование комнаты
-        room_exists = await self.check_room_exists(self.room_slug)
-        if not room_exists:
-            print(f"❌ Комната {self.room_slug} не существует")
+        # id комнаты запоминаем, чтобы не искать ее при каждом сообщении
+        self.room_id = await self.get_room_id(self.room_slug)
+        if self.room_id is None:
+            logger.warning("❌ Комната %s не существует", self.room_slug)
             await self.close()
             return
 
@@ -41,444 +382,432 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
         await self.accept()
-        print(f"✅ WebSocket подключен: {self.user.username} к комнате {self.room_slug}")
-        
-        # Регистрируем канал пользователя для личных сообщений
-        self.user_channels[self.user.username] = self.channel_name
+        logger.debug("✅ WebSocket подключен: %s к комнате %s", self.user.username, self.room_slug)
         
-        # Добавляем пользователя в список подключенных
-        await self.add_user_to_room()
-        
-        # Отправляем обновленный список пользователей ВСЕМ участникам
-        await self.send_online_users()
-        
-        # Уведомляем всех о подключении нового пользователя
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_joined',
-                'username': self.user.username,
-                'timestamp': timezone.now().isoformat()
-            }
+        # Личная группа пользователя для личных сообщений (работает между воркерами)
+        await self.channel_layer.group_add(
+            user_group_name(self.user.id),
+            self.channel_name
         )
         
-        # Отправляем историю сообщений только подключившемуся пользователю
-        await self.send_history()
-        
-        # Отправляем историю личных сообщений
-        await self.send_private_history()
+        # Добавляем соединение в список подключенных и продлеваем запись, пока соединение живо.
+        # О входе уведомляем, только если других соединений у пользователя в комнате нет
+        if not await self.add_user_to_room():
+            self.enqueue_presence_event('joined')
+        self.heartbeat_task = asyncio.create_task(self.presence_heartbeat())
+
+        # Список онлайн, историю комнаты и личную историю загружаем одновременно:
+        # запросы к Redis и БД идут параллельно, а не друг за другом
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.send_online_users())
+            tg.create_task(self.send_history())
+            tg.create_task(self.send_private_history())
 
     async def disconnect(self, close_code):
         # Уведомляем всех об отключении пользователя
         if hasattr(self, 'room_group_name') and not self.user.is_anonymous:
-            # Удаляем пользователя из списка
-            await self.remove_user_from_room()
-            
-            # Удаляем канал пользователя
-            if self.user.username in self.user_channels:
-                del self.user_channels[self.user.username]
+            # Удаляем соединение из списка через PRESENCE_LEAVE_GRACE и уведомляем всех об уходе,
+            # если других соединений у пользователя к тому времени нет
+            heartbeat_task = getattr(self, 'heartbeat_task', None)
+            if heartbeat_task is not None:
+                heartbeat_task.cancel()
+                run_in_background(self.remove_user_from_room())
             
-            # Отправляем обновленный список пользователей
-            await self.send_online_users()
-            
-            await self.channel_layer.group_send(
+            await self.channel_layer.group_discard(
                 self.room_group_name,
-                {
-                    'type': 'user_left',
-                    'username': self.user.username,
-                    'timestamp': timezone.now().isoformat()
-                }
+                self.channel_name
             )
-            
             await self.channel_layer.group_discard(
-                self.room_group_name,
+                user_group_name(self.user.id),
                 self.channel_name
             )
         
-        print(f"❌ WebSocket отключен: {self.user.username if not self.user.is_anonymous else 'Anonymous'}")
+        logger.debug("❌ WebSocket отключен: %s", self.user)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        # Разбор и проверка типов за один вызов; некорректный кадр просто отбрасываем.
+        # Бинарные кадры разбираем как есть, без предварительного декодирования в str
         try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'chat_message')
-            
-            if message_type == 'private_message':
-                await self.handle_private_message(text_data_json)
+            incoming = msgspec.json.decode(
+                text_data if text_data is not None else bytes_data,
+                type=IncomingMessage
+            )
+        except msgspec.DecodeError as e:
+            logger.warning("❌ Некорректный кадр от %s: %s", self.user.username, e)
+            return
+
+        try:
+            if incoming.type == 'private_message':
+                await self.handle_private_message(incoming)
             else:
-                await self.handle_chat_message(text_data_json)
+                await self.handle_chat_message(incoming)
                 
         except Exception as e:
-            print(f"❌ Ошибка обработки сообщения: {e}")
+            logger.exception("❌ Ошибка обработки сообщения: %s", e)
 
-    async def handle_chat_message(self, text_data_json):
+    async def handle_chat_message(self, incoming):
         """Обработка обычных сообщений в чат"""
-        message = text_data_json.get('message', '').strip()
-        username = text_data_json.get('username', '')
+        message = incoming.message.strip()
         
         if not message:
             return
 
-        print(f"📨 Сообщение от {username}: {message}")
+        # Автор - всегда аутентифицированный пользователь соединения, а не поле от клиента
+        username = self.user.username
+        logger.debug("📨 Сообщение от %s: %s", username, message)
+
+        # id и время выдаем сразу, чтобы разослать сообщение, не дожидаясь INSERT
+        message_obj = Message(
+            id=await next_message_id(),
+            user_id=self.user.id,
+            room_id=self.room_id,
+            content=message,
+            date_added=datetime.now(dt_tz.utc)
+        )
 
-        # Проверяем, что пользователь существует
-        user_exists = await self.check_user_exists(username)
-        if not user_exists:
-            print(f"❌ Пользователь {username} не существует")
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Пользователь не найден'
-            }))
-            return
+        # Сериализуем кадр один раз и отправляем его ВСЕМ участникам комнаты
+        frame = orjson.dumps(NewMessageFrame(
+            message=message,
+            username=username,
+            message_id=message_obj.id,
+            timestamp=message_obj.date_added
+        ))
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'chat_message',
+                'frame': frame,
+            }
+        )
 
-        # Сохраняем сообщение в БД
-        saved_message = await self.save_message(username, self.room_slug, message)
+        # Добавляем сообщение в буфер
+        buffered = await self.add_message_to_buffer(message_obj)
 
-        if saved_message:
-            # Добавляем сообщение в буфер
-            await self.add_message_to_buffer(saved_message)
-            
-            # Отправляем сообщение ВСЕМ участникам комнаты
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'username': username,
-                    'message_id': saved_message.id,
-                    'timestamp': saved_message.date_added.isoformat() if saved_message.date_added else timezone.now().isoformat(),
-                }
-            )
-        else:
-            print("❌ Не удалось сохранить сообщение, трансляция отменена")
+        # Сохраняем сообщение в БД в фоне, вместе с другими сообщениями процесса
+        enqueue_message_write(message_obj, self.room_slug, buffered)
 
-    async def handle_private_message(self, text_data_json):
+    async def handle_private_message(self, incoming):
         """Обработка личных сообщений"""
-        message = text_data_json.get('message', '').strip()
-        to_username = text_data_json.get('to_username', '')
-        from_username = text_data_json.get('username', '')
+        message = incoming.message.strip()
+        to_username = incoming.to_username
         
         if not message or not to_username:
             return
             
-        print(f"📨 Личное сообщение от {from_username} к {to_username}: {message}")
+        from_username = self.user.username
+        logger.debug("📨 Личное сообщение от %s к %s: %s", from_username, to_username, message)
 
-        # Проверяем, что оба пользователя существуют
-        from_user_exists = await self.check_user_exists(from_username)
-        to_user_exists = await self.check_user_exists(to_username)
+        # Находим id получателя (обычно из кэша)
+        to_user_id = await self.get_user_id(to_username)
         
-        if not from_user_exists or not to_user_exists:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Пользователь не найден'
-            }))
+        if to_user_id is None:
+            await self.send(bytes_data=ERROR_USER_NOT_FOUND)
             return
 
         # Сохраняем личное сообщение в БД
-        saved_message = await self.save_private_message(from_username, to_username, message)
+        saved_message = await self.save_private_message(self.user.id, to_user_id, message)
 
         if saved_message:
-            # Используем текущее время, если timestamp недоступен
-            timestamp = getattr(saved_message, 'timestamp', timezone.now())
+            # timestamp всегда заполнен через auto_now_add
+            timestamp = saved_message.timestamp
             
-            # Отправляем сообщение отправителю
-            await self.send(text_data=json.dumps({
-                'type': 'private_message_sent',
-                'message': message,
-                'to_username': to_username,
-                'timestamp': timestamp.isoformat(),
-                'message_id': saved_message.id
-            }))
-
-            # Отправляем сообщение получателю, если он онлайн
-            if to_username in self.user_channels:
-                await self.channel_layer.send(
-                    self.user_channels[to_username],
+            # Подтверждение отправителю и доставку получателю выполняем одновременно
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self.send(bytes_data=orjson.dumps({
+                    'type': 'private_message_sent',
+                    'message': message,
+                    'to_username': to_username,
+                    'timestamp': timestamp,
+                    'message_id': saved_message.id
+                })))
+
+                # Отправляем сообщение во все соединения получателя; если он не в сети, группа пуста,
+                # а сообщение он получит из истории при следующем подключении
+                tg.create_task(self.channel_layer.group_send(
+                    user_group_name(to_user_id),
                     {
                         'type': 'private_message',
-                        'message': message,
                         'from_username': from_username,
-                        'timestamp': timestamp.isoformat(),
-                        'message_id': saved_message.id
+                        'frame': orjson.dumps({
+                            'type': 'private_message',
+                            'message': message,
+                            'from_username': from_username,
+                            'timestamp': timestamp,
+                            'message_id': saved_message.id
+                        }),
                     }
-                )
-                print(f"✅ Личное сообщение доставлено пользователю {to_username}")
-            else:
-                print(f"ℹ️ Пользователь {to_username} не в сети, сообщение сохранено")
+                ))
+            logger.debug("✅ Личное сообщение отправлено пользователю %s", to_username)
         else:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Не удалось отправить личное сообщение'
-            }))
+            await self.send(bytes_data=ERROR_PRIVATE_MESSAGE_FAILED)
 
     # ОБРАБОТЧИКИ ДЛЯ РАЗНЫХ ТИПОВ СООБЩЕНИЙ:
 
     async def chat_message(self, event):
-        """Обработчик для чат-сообщений - отправляет ВСЕМ участникам"""
-        print(f"📤 Транслируем сообщение от {event['username']} всем участникам")
-        await self.send(text_data=json.dumps({
-            'type': 'new_message',
-            'message': event['message'],
-            'username': event['username'],
-            'message_id': event.get('message_id'),
-            'timestamp': event.get('timestamp'),
-        }))
-
-    async def private_message(self, event):
-        """Обработчик для личных сообщений - отправляет конкретному пользователю"""
-        print(f"📤 Доставляем личное сообщение от {event['from_username']}")
-        await self.send(text_data=json.dumps({
-            'type': 'private_message',
-            'message': event['message'],
-            'from_username': event['from_username'],
-            'timestamp': event.get('timestamp'),
-            'message_id': event.get('message_id'),
-        }))
+        """Обработчик для чат-сообщений - отправляет ВСЕМ участникам готовый кадр"""
+        await self.send(bytes_data=event['frame'])
 
-    async def user_joined(self, event):
-        """Обработчик для уведомлений о входе пользователя"""
-        print(f"👤 Пользователь {event['username']} присоединился")
-        await self.send(text_data=json.dumps({
-            'type': 'user_activity',
-            'activity': 'joined',
-            'username': event['username'],
-            'timestamp': event.get('timestamp'),
-            'message': f"{event['username']} присоединился к чату"
-        }))
+    async def message_retract(self, event):
+        """Обработчик отзыва сообщения, которое не удалось сохранить"""
+        await self.send(bytes_data=event['frame'])
 
-    async def user_left(self, event):
-        """Обработчик для уведомлений о выходе пользователя"""
-        print(f"👤 Пользователь {event['username']} покинул чат")
-        await self.send(text_data=json.dumps({
-            'type': 'user_activity',
-            'activity': 'left',
-            'username': event['username'],
-            'timestamp': event.get('timestamp'),
-            'message': f"{event['username']} покинул чат"
-        }))
+    async def private_message(self, event):
+        """Обработчик для личных сообщений - отправляет конкретному пользователю готовый кадр"""
+        logger.debug("📤 Доставляем личное сообщение от %s", event['from_username'])
+        await self.send(bytes_data=event['frame'])
 
-    async def online_users(self, event):
-        """Обработчик для отправки списка онлайн пользователей"""
-        await self.send(text_data=json.dumps({
-            'type': 'online_users',
-            'users': event['users'],
-            'count': event['count']
-        }))
+    async def presence_batch(self, event):
+        """Обработчик пачки событий присутствия - отправляет клиенту готовые кадры"""
+        # Метод связываем один раз на всю пачку, а не на каждый кадр
+        send = self.send
+        for frame in event['frames']:
+            await send(bytes_data=frame)
 
     # МЕТОДЫ ДЛЯ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ ОНЛАЙН
 
+    def presence_keys(self):
+        """Ключи присутствия: пользователи комнаты и соединения текущего пользователя в ней"""
+        return [presence_key(self.room_slug), connections_key(self.room_slug, self.user.username)]
+
     async def add_user_to_room(self):
-        """Добавляет пользователя в список подключенных к комнате"""
-        if self.room_slug not in self.connected_users:
-            self.connected_users[self.room_slug] = set()
-        
-        self.connected_users[self.room_slug].add(self.user.username)
-        print(f"👥 Пользователь {self.user.username} добавлен в комнату {self.room_slug}")
+        """Добавляет соединение в список подключенных и возвращает число других соединений пользователя"""
+        others = await self.touch_presence()
+        logger.debug("👥 Пользователь %s добавлен в комнату %s", self.user.username, self.room_slug)
+        return others
+
+    async def touch_presence(self):
+        """Обновляет время соединения и пользователя в списке онлайн (score - время последнего продления)"""
+        # Зависшие записи скрипт чистит заодно, чтобы список не рос после падений воркеров
+        return await get_script(TOUCH_PRESENCE_SCRIPT)(
+            keys=self.presence_keys(),
+            args=[self.user.username, self.channel_name, time.time(), PRESENCE_TTL]
+        )
+
+    async def presence_heartbeat(self):
+        """Продлевает запись пользователя в списке онлайн, пока соединение открыто"""
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            try:
+                await self.touch_presence()
+            except Exception as e:
+                logger.warning("⚠️ Не удалось продлить присутствие %s: %s", self.user.username, e)
 
     async def remove_user_from_room(self):
-        """Удаляет пользователя из списка подключенных к комнате"""
-        if self.room_slug in self.connected_users:
-            if self.user.username in self.connected_users[self.room_slug]:
-                self.connected_users[self.room_slug].remove(self.user.username)
-                print(f"👥 Пользователь {self.user.username} удален из комнаты {self.room_slug}")
-                
-                # Если комната пуста, удаляем ее (но буфер сообщений сохраняем)
-                if len(self.connected_users[self.room_slug]) == 0:
-                    del self.connected_users[self.room_slug]
+        """Удаляет соединение из списка подключенных после PRESENCE_LEAVE_GRACE и объявляет выход,
+        если у пользователя не осталось других соединений в комнате"""
+        await asyncio.sleep(PRESENCE_LEAVE_GRACE)
+        try:
+            # Пустой ключ Redis удаляет сам (буфер сообщений при этом сохраняется)
+            left = await get_script(LEAVE_PRESENCE_SCRIPT)(
+                keys=self.presence_keys(),
+                args=[self.user.username, self.channel_name, time.time(), PRESENCE_TTL]
+            )
+        except Exception as e:
+            logger.exception("❌ Ошибка удаления %s из комнаты %s: %s", self.user.username, self.room_slug, e)
+            return
+        if left:
+            logger.debug("👥 Пользователь %s удален из комнаты %s", self.user.username, self.room_slug)
+            self.enqueue_presence_event('left')
 
     async def send_online_users(self):
-        """Отправляет обновленный список онлайн пользователей ВСЕМ в комнате"""
-        if self.room_slug in self.connected_users:
-            users = list(self.connected_users[self.room_slug])
-            users_count = len(users)
-            
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'online_users',
-                    'users': users,
-                    'count': users_count
-                }
+        """Отправляет полный список онлайн пользователей только текущему пользователю"""
+        await self.send(bytes_data=await get_presence_snapshot(self.room_slug))
+
+    def enqueue_presence_event(self, activity):
+        """Ставит событие присутствия в очередь комнаты и при необходимости планирует рассылку"""
+        queue = _presence_queues.get(self.room_slug)
+        if queue is None:
+            queue = _presence_queues[self.room_slug] = asyncio.Queue()
+            run_in_background(
+                flush_presence(self.channel_layer, self.room_slug, self.room_group_name)
             )
-            print(f"👥 Отправлен список пользователей: {users}")
+
+        queue.put_nowait(UserActivityFrame(
+            activity=activity,
+            username=self.user.username,
+            timestamp=datetime.now(dt_tz.utc),
+            message=f"{self.user.username} {ACTIVITY_MESSAGES[activity]}"
+        ))
 
     # МЕТОДЫ ДЛЯ ЛИЧНЫХ СООБЩЕНИЙ
 
-    @sync_to_async
-    def save_private_message(self, from_username, to_username, message):
-        """Сохраняет личное сообщение в БД"""
+    @db_sync_to_async
+    def save_private_message(self, from_user_id, to_user_id, message):
+        """Сохраняет личное сообщение в БД по уже известным id, без дополнительных SELECT"""
         try:
-            from_user = get_user_model().objects.get(username=from_username)
-            to_user = get_user_model().objects.get(username=to_username)
-            
             private_message = PrivateMessage.objects.create(
-                from_user=from_user,
-                to_user=to_user,
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
                 content=message
             )
-            print(f"💾 Личное сообщение сохранено: {from_username} -> {to_username}")
+            logger.debug("💾 Личное сообщение сохранено: %s -> %s", from_user_id, to_user_id)
             return private_message
         except Exception as e:
-            print(f"❌ Ошибка сохранения личного сообщения: {e}")
+            logger.exception("❌ Ошибка сохранения личного сообщения: %s", e)
             return None
 
-    @sync_to_async
-    def get_private_messages(self, username, limit=50):
+    @db_sync_to_async
+    def get_private_messages(self, user_id, limit=50):
         """Получает историю личных сообщений пользователя"""
         try:
-            User = get_user_model()
-            user = User.objects.get(username=username)
+            # Одним запросом берем последние сообщения, где пользователь отправитель или получатель
+            last_messages = PrivateMessage.objects.filter(
+                Q(from_user_id=user_id) | Q(to_user_id=user_id)
+            ).select_related('from_user', 'to_user').order_by('-timestamp')[:limit]
             
-            # Получаем сообщения где пользователь отправитель или получатель
-            sent_messages = PrivateMessage.objects.filter(from_user=user)
-            received_messages = PrivateMessage.objects.filter(to_user=user)
-            
-            # Объединяем и сортируем
-            from itertools import chain
-            all_messages = sorted(
-                chain(sent_messages, received_messages),
-                key=lambda x: x.timestamp
-            )
-            
-            messages_list = []
-            for msg in all_messages[-limit:]:
-                messages_list.append({
+            # В ответе самые старые первыми
+            return [
+                {
                     'id': msg.id,
                     'message': msg.content,
                     'from_username': msg.from_user.username,
                     'to_username': msg.to_user.username,
-                    'timestamp': msg.timestamp.isoformat(),
-                    'direction': 'sent' if msg.from_user == user else 'received'
-                })
-            return messages_list
+                    'timestamp': msg.timestamp,
+                    'direction': 'sent' if msg.from_user_id == user_id else 'received'
+                }
+                for msg in reversed(list(last_messages))
+            ]
         
         except Exception as e:
-            print(f"❌ Ошибка загрузки личной истории: {e}")
+            logger.exception("❌ Ошибка загрузки личной истории: %s", e)
             return []
 
     async def send_private_history(self):
         """Отправляет историю личных сообщений текущему пользователю"""
-        messages = await self.get_private_messages(self.user.username)
-        await self.send(text_data=json.dumps({
+        messages = await self.get_private_messages(self.user.id)
+        await self.send(bytes_data=orjson.dumps({
             'type': 'private_history',
             'messages': messages
         }))
-        print(f"📚 Отправлено {len(messages)} личных сообщений для {self.user.username}")
+        logger.debug("📚 Отправлено %s личных сообщений для %s", len(messages), self.user.username)
 
     # СУЩЕСТВУЮЩИЕ МЕТОДЫ
 
     async def add_message_to_buffer(self, message_obj):
-        """Добавляет сообщение в буфер для всех пользователей комнаты"""
-        if self.room_slug not in self.message_buffer:
-            self.message_buffer[self.room_slug] = []
-        
-        message_data = {
-            'id': message_obj.id,
-            'message': message_obj.content,
-            'username': message_obj.user.username,
-            'timestamp': message_obj.date_added.isoformat() if message_obj.date_added else timezone.now().isoformat()
-        }
+        """Добавляет сообщение в буфер комнаты в Redis (общий для всех воркеров) и возвращает запись буфера"""
+        buffered = orjson.dumps(BufferedMessage(
+            id=message_obj.id,
+            message=message_obj.content,
+            username=self.user.username,
+            date_added=message_obj.date_added
+        ))
         
-        # Ограничиваем размер буфера (последние 50 сообщений)
-        self.message_buffer[self.room_slug].append(message_data)
-        if len(self.message_buffer[self.room_slug]) > 50:
-            self.message_buffer[self.room_slug] = self.message_buffer[self.room_slug][-50:]
+        # Новые сообщения в начале списка, храним только последние MESSAGE_BUFFER_SIZE
+        key = buffer_key(self.room_slug)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.lpush(key, buffered)
+            pipe.ltrim(key, 0, MESSAGE_BUFFER_SIZE - 1)
+            await pipe.execute()
         
-        print(f"💾 Сообщение {message_obj.id} добавлено в буфер комнаты {self.room_slug}")
-
-    @sync_to_async
-    def check_user_exists(self, username):
-        """Проверяет существование пользователя"""
-        return get_user_model().objects.filter(username=username).exists()
-
-    @sync_to_async
-    def check_room_exists(self, room_slug):
-        """Проверяет существование комнаты"""
-        return Room.objects.filter(slug=room_slug).exists()
-
-    @sync_to_async  
-    def save_message(self, username, room_slug, message):  
-        try:
-            user = get_user_model().objects.get(username=username)
-            room = Room.objects.get(slug=room_slug)  
-
-            message_obj = Message.objects.create(user=user, room=room, content=message)
-            print(f"💾 Сообщение сохранено: {username} в комнате {room_slug} (ID: {message_obj.id})")
-            return message_obj
-        except get_user_model().DoesNotExist:
-            print(f"❌ Пользователь {username} не найден в БД")
-            return None
-        except Room.DoesNotExist:
-            print(f"❌ Комната {room_slug} не найдена")
-            return None
-        except Exception as e:
-            print(f"❌ Ошибка сохранения сообщения: {e}")
-            return None
-
-    @sync_to_async
-    def get_room_messages(self, room_slug, limit=50):
-        """Получает сообщения из БД"""
+        logger.debug("💾 Сообщение %s добавлено в буфер комнаты %s", message_obj.id, self.room_slug)
+        return buffered
+
+    async def get_user_id(self, username):
+        """Возвращает id пользователя или None, если пользователя не существует"""
+        # Отправитель уже аутентифицирован - за ним в БД ходить не нужно
+        if username == self.user.username:
+            return self.user.id
+
+        user_id = get_cached(_user_cache, username)
+        if user_id is not None:
+            return user_id
+
+        user_id = await self.get_user_id_from_db(username)
+        if user_id is not None:
+            _user_cache[username] = (time.monotonic(), user_id)
+        return user_id
+
+    @db_sync_to_async
+    def get_user_id_from_db(self, username):
+        """Получает id пользователя из БД"""
+        return User.objects.filter(username=username).values_list('id', flat=True).first()
+
+    async def get_room_id(self, room_slug):
+        """Возвращает id комнаты или None, если комнаты не существует"""
+        room_id = get_cached(_room_cache, room_slug)
+        if room_id is not None:
+            return room_id
+
+        room_id = await self.get_room_id_from_db(room_slug)
+        if room_id is not None:
+            _room_cache[room_slug] = (time.monotonic(), room_id)
+        return room_id
+
+    @db_sync_to_async
+    def get_room_id_from_db(self, room_slug):
+        """Получает id комнаты из БД"""
+        return Room.objects.filter(slug=room_slug).values_list('id', flat=True).first()
+
+    @db_sync_to_async
+    def get_room_messages(self, room_id, limit=50, after_id=0):
+        """Получает сообщения новее after_id из БД одним запросом, без создания объектов моделей"""
         try:
-            room = Room.objects.get(slug=room_slug)
-            messages = Message.objects.filter(room=room).select_related('user').order_by('date_added')[:limit]
+            # id комнаты известен с подключения - фильтруем по нему без JOIN с таблицей комнат
+            rows = Message.objects.filter(room_id=room_id, id__gt=after_id).order_by('-date_added').values_list(
+                'id', 'content', 'user__username', 'date_added'
+            )[:limit]
             
-            messages_list = []
-            for msg in messages:
-                messages_list.append({
-                    'id': msg.id,
-                    'message': msg.content,
-                    'username': msg.user.username,
-                    'date_added': msg.date_added.isoformat() if msg.date_added else None
-                })
-            return messages_list
+            # Берем последние limit сообщений, в ответе самые старые первыми
+            return [
+                {
+                    'id': msg_id,
+                    'message': content,
+                    'username': username,
+                    'date_added': date_added.isoformat()
+                }
+                for msg_id, content, username, date_added in reversed(list(rows))
+            ]
         except Exception as e:
-            print(f"❌ Ошибка загрузки истории: {e}")
+            logger.exception("❌ Ошибка загрузки истории: %s", e)
             return []
 
-    async def get_combined_messages(self, room_slug, limit=50):
-        """Получает сообщения из БД и объединяет с буфером"""
+    async def get_combined_messages(self, room_slug, limit=50, after_id=0):
+        """Получает сообщения новее after_id из буфера, а из БД - только если буфера не хватает.
+
+        Возвращает сообщения уже в виде JSON: записи буфера хранятся в формате истории
+        и попадают в кадр как есть, без повторного разбора и сериализации.
+        """
         try:
-            # Получаем сообщения из БД
-            db_messages = await self.get_room_messages(room_slug, limit)
-            
-            # Получаем сообщения из буфера
-            buffer_messages = self.message_buffer.get(room_slug, [])
-            
-            # Объединяем сообщения, убирая дубликаты по ID
-            combined_messages = []
-            seen_ids = set()
-            
-            # Сначала добавляем сообщения из буфера (более новые)
-            for msg in reversed(buffer_messages):
-                if msg['id'] not in seen_ids:
-                    combined_messages.append({
-                        'id': msg['id'],
-                        'message': msg['message'],
-                        'username': msg['username'],
-                        'date_added': msg['timestamp']
-                    })
-                    seen_ids.add(msg['id'])
-            
-            # Затем добавляем сообщения из БД (более старые)
-            for msg in db_messages:
-                if msg['id'] not in seen_ids:
-                    combined_messages.append(msg)
-                    seen_ids.add(msg['id'])
-            
-            # Сортируем по времени (самые старые первыми)
-            combined_messages.sort(key=lambda x: x['date_added'] if x['date_added'] else '')
+            # Получаем сообщения из буфера (в Redis они лежат от новых к старым)
+            raw_buffer = await get_redis().lrange(buffer_key(room_slug), 0, -1)
+            buffer_messages = []
+            for raw in reversed(raw_buffer):
+                msg = orjson.loads(raw)
+                if msg['id'] > after_id:
+                    buffer_messages.append((msg, raw.encode()))
+
+            # Буфер покрывает всю историю, если в нем уже limit сообщений или он доходит до after_id.
+            # Иначе (пустой буфер после перезапуска Redis, мало сообщений) догружаем из БД
+            if len(buffer_messages) >= limit or len(buffer_messages) < len(raw_buffer):
+                return [raw for _, raw in buffer_messages[-limit:]]
+
+            db_messages = await self.get_room_messages(self.room_id, limit, after_id)
+
+            # Ключ сортировки (время, id) считаем один раз на сообщение
+            buffer_entries = [((msg['date_added'], msg['id']), raw) for msg, raw in buffer_messages]
+            db_entries = [((msg['date_added'], msg['id']), orjson.dumps(msg)) for msg in db_messages]
+
+            # Оба списка уже идут от старых к новым - сливаем их за один проход вместо сортировки.
+            # dict по ID убирает дубликаты и сохраняет порядок слияния
+            combined_messages = {}
+            for (_, msg_id), raw in heapq.merge(buffer_entries, db_entries, key=itemgetter(0)):
+                combined_messages.setdefault(msg_id, raw)
             
             # Ограничиваем лимитом
-            return combined_messages[-limit:]
+            return list(combined_messages.values())[-limit:]
             
         except Exception as e:
-            print(f"❌ Ошибка объединения сообщений: {e}")
-            return await self.get_room_messages(room_slug, limit)
+            logger.exception("❌ Ошибка объединения сообщений: %s", e)
+            return [orjson.dumps(msg) for msg in await self.get_room_messages(self.room_id, limit, after_id)]
 
     async def send_history(self):
-        """Отправляет полную историю сообщений (из БД + буфера) только текущему пользователю"""
-        messages = await self.get_combined_messages(self.room_slug)
-        await self.send(text_data=json.dumps({
-            'type': 'history',
-            'messages': messages
-        }))
-        print(f"📚 Отправлено {len(messages)} сообщений из истории для {self.user.username}")
\ No newline at end of file
+        """Отправляет историю сообщений (из БД + буфера) только текущему пользователю.
+
+        Если клиент уже видел сообщения до last_seen_id, отправляются только более новые.
+        """
+        messages = await self.get_combined_messages(self.room_slug, after_id=self.last_seen_id)
+        if not messages and self.last_seen_id:
+            return
+        # Кадр собираем из готовых JSON сообщений
+        await self.send(bytes_data=b'{"type":"history","messages":[' + b','.join(messages) + b']}')
+        logger.debug("📚 Отправлено %s сообщений из истории для %s", len(messages), self.user.username)
\ No newline at end of file
@@ -0,0 +1,43 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import msgspec
+
+
+class IncomingMessage(msgspec.Struct):
+    """Кадр от клиента: сообщение в чат или личное сообщение. Лишние поля игнорируются"""
+    type: str = 'chat_message'
+    message: str = ''
+    to_username: str = ''
+
+
+# Кадры, которые сервер отправляет клиенту. orjson сериализует dataclass напрямую,
+# поэтому на горячем пути не нужно собирать промежуточный dict
+
+@dataclass(slots=True)
+class NewMessageFrame:
+    """Новое сообщение в чате комнаты"""
+    type: str = field(default='new_message', init=False)
+    message: str
+    username: str
+    message_id: int
+    timestamp: datetime
+
+
+@dataclass(slots=True)
+class UserActivityFrame:
+    """Вход или выход пользователя из комнаты"""
+    type: str = field(default='user_activity', init=False)
+    activity: str
+    username: str
+    timestamp: datetime
+    message: str
+
+
+@dataclass(slots=True)
+class BufferedMessage:
+    """Запись буфера последних сообщений комнаты в Redis - в том же виде, что и сообщение истории"""
+    id: int
+    message: str
+    username: str
+    date_added: datetime
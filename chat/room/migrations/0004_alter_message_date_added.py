@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-15 10:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0003_privatemessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date_added',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-15 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0004_alter_message_date_added'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-date_added'], name='message_room_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['from_user', '-timestamp'], name='privmsg_from_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['to_user', '-timestamp'], name='privmsg_to_ts_idx'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Room(models.Model):
     name = models.CharField(max_length=255)
@@ -9,10 +10,15 @@ class Message(models.Model):
     room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name='messages', on_delete=models.CASCADE)
     content = models.TextField()
-    date_added = models.DateTimeField(auto_now_add=True)
+    # Время задается при рассылке сообщения, еще до записи в БД
+    date_added = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ('date_added',)
+        # История комнаты читается как последние сообщения комнаты по времени
+        indexes = [
+            models.Index(fields=['room', '-date_added'], name='message_room_date_idx'),
+        ]
 
 class PrivateMessage(models.Model):
     from_user = models.ForeignKey(User, related_name='sent_messages', on_delete=models.CASCADE)
@@ -22,4 +28,9 @@ class PrivateMessage(models.Model):
     is_read = models.BooleanField(default=False)
 
     class Meta:
-        ordering = ('timestamp',)
\ No newline at end of file
+        ordering = ('timestamp',)
+        # Личная история - последние сообщения, где пользователь отправитель или получатель
+        indexes = [
+            models.Index(fields=['from_user', '-timestamp'], name='privmsg_from_ts_idx'),
+            models.Index(fields=['to_user', '-timestamp'], name='privmsg_to_ts_idx'),
+        ]
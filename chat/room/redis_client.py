@@ -0,0 +1,41 @@
+import redis.asyncio as redis
+from django.conf import settings
+
+# Общий клиент Redis для состояния чата (онлайн пользователи, буфер сообщений)
+_client = None
+
+
+def get_redis():
+    """Возвращает общий асинхронный клиент Redis, создавая его при первом обращении"""
+    global _client
+    if _client is None:
+        _client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
+
+
+# Зарегистрированные скрипты Lua: исходный текст -> скрипт общего клиента
+_scripts = {}
+
+
+def get_script(source):
+    """Возвращает скрипт Lua, зарегистрированный в общем клиенте Redis"""
+    client = get_redis()
+    script = _scripts.get(source)
+    if script is None or script.registered_client is not client:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+
+def presence_key(room_slug):
+    """Ключ sorted set пользователей онлайн в комнате"""
+    return f'presence:{room_slug}'
+
+
+def connections_key(room_slug, username):
+    """Ключ sorted set открытых соединений пользователя в комнате"""
+    return f'presence:{room_slug}:{username}'
+
+
+def buffer_key(room_slug):
+    """Ключ списка последних сообщений комнаты (записи в формате сообщений истории)"""
+    return f'room:{room_slug}:history'
@@ -1,3 +1,287 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import orjson
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase, override_settings
+
+from . import consumers, redis_client
+from .events import BufferedMessage
+from .models import Message, Room
+from .redis_client import buffer_key
+from .routing import websocket_urlpatterns
+
+User = get_user_model()
+
+application = URLRouter(websocket_urlpatterns)
+
+
+# Запросы к БД идут из пула потоков consumer'а, поэтому данные тестов должны быть закоммичены
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerTestCase(TransactionTestCase):
+    """Общая подготовка: Redis в памяти и сброс состояния модуля consumers между тестами"""
+
+    def setUp(self):
+        redis_client._client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        consumers._room_cache.clear()
+        consumers._user_cache.clear()
+        consumers._presence_queues.clear()
+        consumers._presence_snapshots.clear()
+        consumers._write_queue = None
+        consumers._write_batch_full = None
+        consumers._writer_task = None
+        consumers._last_message_id = 0
+
+        self.room = Room.objects.create(name='Комната', slug='room')
+        self.alice = User.objects.create_user('alice', password='password')
+        self.bob = User.objects.create_user('bob', password='password')
+
+    def create_messages(self, count, user=None):
+        """Создает count сообщений комнаты в БД и возвращает их"""
+        return [
+            Message.objects.create(room=self.room, user=user or self.alice, content=f'Сообщение {number}')
+            for number in range(count)
+        ]
+
+    async def buffer_messages(self, messages):
+        """Кладет сообщения в буфер комнаты в Redis так же, как это делает consumer"""
+        for message in messages:
+            await redis_client.get_redis().lpush(buffer_key(self.room.slug), orjson.dumps(BufferedMessage(
+                id=message.id,
+                message=message.content,
+                username=message.user.username,
+                date_added=message.date_added
+            )))
+
+    async def connect(self, user, query=''):
+        communicator = WebsocketCommunicator(application, f'/ws/{self.room.slug}/{query}')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frames(self, communicator, wait=0.3):
+        """Собирает кадры, пока клиенту ничего не приходит wait секунд"""
+        frames = []
+        while not await communicator.receive_nothing(timeout=wait):
+            output = await communicator.receive_output()
+            frames.append(orjson.loads(output.get('bytes') or output['text']))
+        return frames
+
+    def frames_of_type(self, frames, frame_type):
+        return [frame for frame in frames if frame['type'] == frame_type]
+
+
+class HistoryTests(ChatConsumerTestCase):
+    """История комнаты при подключении"""
+
+    async def history_ids(self, query=''):
+        communicator = await self.connect(self.alice, query)
+        frames = self.frames_of_type(await self.receive_frames(communicator), 'history')
+        await communicator.disconnect()
+        self.assertLessEqual(len(frames), 1)
+        return [message['id'] for message in frames[0]['messages']] if frames else None
+
+    async def test_cold_buffer_loads_latest_messages_from_database(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(60)
+
+        self.assertEqual(await self.history_ids(), [message.id for message in messages[-50:]])
+
+    async def test_full_buffer_skips_database(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(55)
+        await self.buffer_messages(messages)
+
+        with mock.patch.object(consumers.ChatConsumer, 'get_room_messages') as get_room_messages:
+            ids = await self.history_ids()
+
+        get_room_messages.assert_not_called()
+        self.assertEqual(ids, [message.id for message in messages[-50:]])
+
+    async def test_buffer_reaching_last_seen_id_skips_database(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(10)
+        await self.buffer_messages(messages)
+
+        with mock.patch.object(consumers.ChatConsumer, 'get_room_messages') as get_room_messages:
+            ids = await self.history_ids(f'?last_seen_id={messages[4].id}')
+
+        get_room_messages.assert_not_called()
+        self.assertEqual(ids, [message.id for message in messages[5:]])
+
+    async def test_partial_buffer_is_merged_with_database_without_duplicates(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(30)
+        # В буфере последние сообщения, часть которых уже есть в БД
+        await self.buffer_messages(messages[20:])
+
+        self.assertEqual(await self.history_ids(), [message.id for message in messages])
+
+    async def test_last_seen_id_sends_only_missed_messages(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(10)
+
+        self.assertEqual(
+            await self.history_ids(f'?last_seen_id={messages[6].id}'),
+            [message.id for message in messages[7:]]
+        )
+
+    async def test_up_to_date_client_gets_no_history(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(10)
+
+        self.assertIsNone(await self.history_ids(f'?last_seen_id={messages[-1].id}'))
+
+
+class MessageWriteTests(ChatConsumerTestCase):
+    """Рассылка сообщений до записи в БД и отзыв несохраненных"""
+
+    async def send_message(self, communicator, text):
+        await communicator.send_to(bytes_data=orjson.dumps({'type': 'chat_message', 'message': text}))
+
+    async def test_message_is_broadcast_and_saved(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        await self.receive_frames(alice)
+        await self.receive_frames(bob)
+
+        await self.send_message(alice, 'Привет')
+        frames = self.frames_of_type(await self.receive_frames(bob), 'new_message')
+
+        self.assertEqual([frame['message'] for frame in frames], ['Привет'])
+        self.assertTrue(await Message.objects.filter(id=frames[0]['message_id'], content='Привет').aexists())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_failed_insert_is_retracted(self):
+        # Счетчик отстал от БД: следующий id уже занят
+        existing = await consumers.database_sync_to_async(self.create_messages)(1)
+        await redis_client.get_redis().set(consumers.MESSAGE_ID_KEY, existing[0].id - 1)
+        communicator = await self.connect(self.alice)
+        await self.receive_frames(communicator)
+
+        await self.send_message(communicator, 'Не сохранится')
+        frames = await self.receive_frames(communicator)
+
+        self.assertEqual(
+            [(frame['type'], frame['message_id']) for frame in frames],
+            [('new_message', existing[0].id), ('message_retract', existing[0].id)]
+        )
+        self.assertEqual(await redis_client.get_redis().llen(buffer_key(self.room.slug)), 0)
+        self.assertEqual(await Message.objects.acount(), 1)
+        await communicator.disconnect()
+
+    async def test_lagging_id_counter_is_raised_after_first_conflict(self):
+        # Счетчик отстал от БД больше чем на один id
+        existing = await consumers.database_sync_to_async(self.create_messages)(3)
+        await redis_client.get_redis().set(consumers.MESSAGE_ID_KEY, existing[0].id - 1)
+        communicator = await self.connect(self.alice)
+        await self.receive_frames(communicator)
+
+        await self.send_message(communicator, 'Не сохранится')
+        lost = await self.receive_frames(communicator)
+        await self.send_message(communicator, 'Сохранится')
+        frames = await self.receive_frames(communicator)
+
+        self.assertEqual(
+            [frame['type'] for frame in lost],
+            ['new_message', 'message_retract']
+        )
+        self.assertEqual([frame['type'] for frame in frames], ['new_message'])
+        self.assertGreater(frames[0]['message_id'], existing[-1].id)
+        self.assertTrue(await Message.objects.filter(id=frames[0]['message_id'], content='Сохранится').aexists())
+        await communicator.disconnect()
+
+    async def test_lost_id_counter_is_reseeded_from_database(self):
+        messages = await consumers.database_sync_to_async(self.create_messages)(3)
+        communicator = await self.connect(self.alice)
+        await self.receive_frames(communicator)
+
+        await redis_client.get_redis().delete(consumers.MESSAGE_ID_KEY)
+        await self.send_message(communicator, 'После сброса')
+        frames = await self.receive_frames(communicator)
+
+        self.assertEqual(
+            [(frame['type'], frame['message_id']) for frame in frames],
+            [('new_message', messages[-1].id + 1)]
+        )
+        self.assertEqual(await Message.objects.acount(), 4)
+        await communicator.disconnect()
+
+
+@mock.patch.object(consumers, 'PRESENCE_LEAVE_GRACE', 0.1)
+class PresenceTests(ChatConsumerTestCase):
+    """Присутствие считается по соединениям, а не по именам пользователей"""
+
+    def activities(self, frames):
+        return [(frame['activity'], frame['username']) for frame in self.frames_of_type(frames, 'user_activity')]
+
+    async def online_users(self):
+        return set(await redis_client.get_redis().zrange(redis_client.presence_key(self.room.slug), 0, -1))
+
+    async def test_leave_is_announced_after_grace(self):
+        bob = await self.connect(self.bob)
+        alice = await self.connect(self.alice)
+        await self.receive_frames(bob)
+
+        await alice.disconnect()
+
+        self.assertEqual(self.activities(await self.receive_frames(bob)), [('left', 'alice')])
+        self.assertEqual(await self.online_users(), {'bob'})
+        await bob.disconnect()
+
+    async def test_reconnect_within_grace_is_silent(self):
+        bob = await self.connect(self.bob)
+        alice = await self.connect(self.alice)
+        await self.receive_frames(bob)
+
+        await alice.disconnect()
+        alice = await self.connect(self.alice)
+
+        self.assertEqual(self.activities(await self.receive_frames(bob)), [])
+        self.assertEqual(await self.online_users(), {'alice', 'bob'})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_closing_two_tabs_and_reconnecting_keeps_user_online(self):
+        bob = await self.connect(self.bob)
+        first_tab = await self.connect(self.alice)
+        second_tab = await self.connect(self.alice)
+        await self.receive_frames(bob)
+
+        await first_tab.disconnect()
+        await second_tab.disconnect()
+        alice = await self.connect(self.alice)
+
+        self.assertEqual(self.activities(await self.receive_frames(bob)), [])
+        self.assertEqual(self.activities(await self.receive_frames(alice)), [])
+        self.assertEqual(await self.online_users(), {'alice', 'bob'})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_closing_one_of_two_tabs_keeps_user_online(self):
+        bob = await self.connect(self.bob)
+        first_tab = await self.connect(self.alice)
+        second_tab = await self.connect(self.alice)
+        await self.receive_frames(bob)
+
+        await first_tab.disconnect()
+
+        self.assertEqual(self.activities(await self.receive_frames(bob)), [])
+        self.assertEqual(await self.online_users(), {'alice', 'bob'})
+        await second_tab.disconnect()
+        await bob.disconnect()
+
+    async def test_reloaded_tab_reaches_other_open_tab(self):
+        bob = await self.connect(self.bob)
+        open_tab = await self.connect(self.alice)
+        reloaded_tab = await self.connect(self.alice)
+
+        await reloaded_tab.disconnect()
+        reloaded_tab = await self.connect(self.alice)
+        for communicator in (bob, open_tab, reloaded_tab):
+            await self.receive_frames(communicator)
+        await reloaded_tab.send_to(bytes_data=orjson.dumps({'type': 'chat_message', 'message': 'Привет'}))
+
+        for communicator in (bob, open_tab, reloaded_tab):
+            frames = self.frames_of_type(await self.receive_frames(communicator), 'new_message')
+            self.assertEqual([frame['message'] for frame in frames], ['Привет'])
+        for communicator in (bob, open_tab, reloaded_tab):
+            await communicator.disconnect()
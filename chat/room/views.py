@@ -3,12 +3,21 @@ from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.core.cache import cache
 from .models import Room, Message
-import json
+import orjson
+
+# Сколько секунд отдаем список комнат из кэша
+ROOMS_CACHE_TTL = 30
 
 def rooms(request):
     """Страница со списком всех комнат"""
-    rooms = Room.objects.all()
+    # Кэшируем только данные, а не страницу целиком: в шапке есть пользователь и CSRF-токен
+    rooms = cache.get_or_set(
+        'room:list',
+        lambda: list(Room.objects.values('name', 'slug')),
+        ROOMS_CACHE_TTL
+    )
     return render(request, 'room/rooms.html', {
         'rooms': rooms
     })
@@ -21,16 +30,18 @@ def room(request, slug):
     messages = Message.objects.filter(room=room).select_related('user').order_by('date_added')[:50]
     
     # Конвертируем сообщения в JSON для передачи в JavaScript
-    messages_json = json.dumps([
+    # orjson сам выводит datetime в ISO формате
+    messages_json = orjson.dumps([
         {
+            'id': msg.id,
             'user': {
                 'username': msg.user.username,
             },
             'content': msg.content,
-            'timestamp': msg.date_added.isoformat() if msg.date_added else None
+            'timestamp': msg.date_added
         }
         for msg in messages
-    ])
+    ]).decode()
     
     return render(request, 'room/room.html', {
         'room': room,